@@ -1,36 +1,87 @@
 # gateway.py — тонкий шлюз Render → Cloudflare Tunnel → твоя локалка
-import os
+import os, re, time, asyncio
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.background import BackgroundTask
 import httpx
+import orjson
 
 UPSTREAM = os.environ.get("UPSTREAM_CONVERTER")  # напр.: https://abc.trycloudflare.com
 if not UPSTREAM:
     raise RuntimeError("Set UPSTREAM_CONVERTER env var to your Cloudflare Tunnel URL")
 
-app = FastAPI(title="ProjectM Music Gateway")
+app = FastAPI(title="ProjectM Music Gateway", default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], allow_methods=["*"], allow_headers=["*"],
 )
 
+class JSONGZipMiddleware(GZipMiddleware):
+    # mp3/m4a уже сжаты, а gzip поверх ломал бы Content-Length/Range при перемотке — /media идёт мимо
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/media/"):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+# JSON /search в разы ужимается на повторяющихся ключах: меньше байт через Render до клиентов
+app.add_middleware(JSONGZipMiddleware, minimum_size=1024, compresslevel=5)
+
 TIMEOUT = httpx.Timeout(60.0, connect=10.0)
-client = httpx.AsyncClient(timeout=TIMEOUT, follow_redirects=True)
+# upstream один — HTTP/2 мультиплексирует параллельные /ping, /search, /media в одном TLS-соединении
+LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=32, keepalive_expiry=60)
+client = httpx.AsyncClient(timeout=TIMEOUT, follow_redirects=True, http2=True, limits=LIMITS)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await client.aclose()
+
+UPSTREAM_BASE = UPSTREAM.rstrip("/")  # UPSTREAM не меняется в рантайме — rstrip один раз при старте
+# кусок стрима /media: меньше yield'ов и ASGI-сообщений на мегабайт; ≤1 MiB, чтобы не раздувать память на соединение
+MEDIA_CHUNK = min(int(os.environ.get("MEDIA_CHUNK", str(256 * 1024))), 1 << 20)
 
 def u(path: str) -> str:
-    return f"{UPSTREAM.rstrip('/')}{path}"
+    return UPSTREAM_BASE + path
+
+def uq(path: str, qs: str) -> str:
+    # строку запроса отдаём upstream как пришла: без dict() (терялись повторные ключи) и перекодирования
+    return f"{UPSTREAM_BASE}{path}?{qs}" if qs else UPSTREAM_BASE + path
+
+# single-flight: одинаковые одновременные запросы (весь сервер MTA жмёт один трек) делят один
+# поход в upstream. shield — отвалившийся клиент не отменяет общий запрос остальным
+_inflight: dict = {}
+
+async def coalesced(key: tuple, fetch):
+    fut = _inflight.get(key)
+    if fut is None:
+        fut = _inflight[key] = asyncio.ensure_future(fetch())
+        fut.add_done_callback(lambda _: _inflight.pop(key, None))
+    return await asyncio.shield(fut)
+
+def json_body(r: httpx.Response) -> bytes:
+    # upstream (наш воркер) всегда отвечает JSON; HTML-страница ошибки Cloudflare и т.п. — это 502
+    if "json" not in r.headers.get("content-type", ""):
+        raise ValueError(f"non-JSON upstream response ({r.status_code})")
+    return r.content
+
+def relay_json(r: httpx.Response) -> Response:
+    # байты upstream как есть: ни разбора, ни повторной сериализации на каждом прокси-хопе
+    return Response(content=json_body(r), status_code=r.status_code, media_type="application/json")
+
+_ROOT_JSON = orjson.dumps({"service": "Gateway", "upstream": UPSTREAM})  # сводка статична — байты готовим один раз
 
 @app.get("/")
 async def root():
     # простая сводка
-    return {"service": "Gateway", "upstream": UPSTREAM}
+    return Response(content=_ROOT_JSON, media_type="application/json")
 
 @app.get("/ping")
 async def ping():
     try:
         r = await client.get(u("/ping"))
-        return JSONResponse(r.json(), status_code=r.status_code)
+        return relay_json(r)
     except Exception as e:
         raise HTTPException(502, f"upstream_error: {e}")
 
@@ -38,24 +89,42 @@ async def ping():
 async def status():
     try:
         r = await client.get(u("/status"))
-        return JSONResponse(r.json(), status_code=r.status_code)
+        return relay_json(r)
     except Exception as e:
         raise HTTPException(502, f"upstream_error: {e}")
 
+# (q, limit) -> (ts, байты JSON): повтор того же запроса (ретраи, несколько игроков ищут одно) в пределах
+# SEARCH_CACHE_TTL не ходит через туннель. Кэшируем только успешные ответы
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", "30"))
+SEARCH_CACHE_MAX = 2048
+_search_cache: dict = {}
+
 @app.get("/search")
 async def search(request: Request):
+    qp, qs = request.query_params, request.url.query
+    key = ((qp.get("q") or "").strip().lower(), qp.get("limit") or "")
+    hit = _search_cache.get(key)
+    if hit and time.monotonic() - hit[0] < SEARCH_CACHE_TTL:
+        return Response(content=hit[1], media_type="application/json")
     try:
-        r = await client.get(u("/search"), params=dict(request.query_params))
-        return JSONResponse(r.json(), status_code=r.status_code)
+        r = await coalesced(("search", qs), lambda: client.get(uq("/search", qs)))
+        data = json_body(r)
     except Exception as e:
         raise HTTPException(502, f"upstream_error: {e}")
+    if r.status_code == 200:
+        _search_cache.pop(key, None)  # переставить в конец порядка вставки
+        _search_cache[key] = (time.monotonic(), data)
+        while len(_search_cache) > SEARCH_CACHE_MAX:
+            _search_cache.pop(next(iter(_search_cache)))  # первым уходит самый старый
+    return Response(content=data, status_code=r.status_code, media_type="application/json")
 
 # /convert: поддержим и GET, и POST — как у тебя на локалке
 @app.get("/convert")
 async def convert_get(request: Request):
     try:
-        r = await client.get(u("/convert"), params=dict(request.query_params))
-        return JSONResponse(r.json(), status_code=r.status_code)
+        qs = request.url.query
+        r = await coalesced(("GET /convert", qs), lambda: client.get(uq("/convert", qs)))
+        return relay_json(r)
     except Exception as e:
         raise HTTPException(502, f"upstream_error: {e}")
 
@@ -63,27 +132,89 @@ async def convert_get(request: Request):
 async def convert_post(request: Request):
     try:
         # прокси с сохранением query и тела
-        qp = dict(request.query_params)
+        qs = request.url.query
         body = await request.body()
         headers = {"Content-Type": request.headers.get("content-type", "application/json")}
-        r = await client.post(u("/convert"), params=qp, content=body, headers=headers)
-        return JSONResponse(r.json(), status_code=r.status_code)
+        key = ("POST /convert", qs, headers["Content-Type"], body)
+        r = await coalesced(key, lambda: client.post(uq("/convert", qs), content=body, headers=headers))
+        return relay_json(r)
     except httpx.HTTPStatusError as he:
         # если upstream вернул 4xx/5xx с JSON — пробросим как есть
         try:
-            return JSONResponse(he.response.json(), status_code=he.response.status_code)
+            return relay_json(he.response)
         except Exception:
             raise HTTPException(he.response.status_code, he.response.text)
     except Exception as e:
         raise HTTPException(502, f"upstream_error: {e}")
 
-# /media — стримим байты (mp3)
-@app.get("/media/{filename}")
-async def media(filename: str):
+# hop-by-hop заголовки (RFC 7230 §6.1) относятся к соединению с upstream и дальше не пробрасываются.
+# content-encoding остаётся: тело идёт через aiter_raw как есть, без распаковки
+HOP_BY_HOP = frozenset({"connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+                        "te", "trailer", "trailers", "transfer-encoding", "upgrade"})
+# date/server uvicorn ставит в ответ сам — upstream'овые дали бы по два заголовка
+DROP_RESPONSE_HEADERS = HOP_BY_HOP | {"date", "server"}
+# от клиента к upstream — только то, что нужно для перемотки и условных запросов
+MEDIA_REQUEST_HEADERS = ("range", "if-range", "if-none-match", "if-modified-since")
+
+# bytes=a-b, bytes=a-, bytes=-n и их списки через запятую; остальное — 416 сразу, без похода в туннель
+# единица диапазона регистронезависима (RFC 9110 §14.1): Bytes=0-1 — тоже валидный Range
+RANGE_RE = re.compile(r"bytes=(?:\d+-\d*|-\d+)(?:\s*,\s*(?:\d+-\d*|-\d+))*", re.I)
+
+def range_ok(value: str) -> bool:
+    value = value.strip().lower()
+    if not RANGE_RE.fullmatch(value):
+        return False
+    for part in value[6:].split(","):
+        start, _, end = part.strip().partition("-")
+        if start and end and int(end) < int(start):
+            return False
+    return True
+
+# те же имена, что отдаёт воркер (<video_id>.mp3|m4a): один проход regex'а в C, ни "..", ни NUL/юникода
+# до туннеля не доходят
+_SAFE_NAME = re.compile(r"\A[A-Za-z0-9_-]{1,64}\.(?:mp3|m4a)\Z")
+
+MEDIA_OK = (200, 206, 304)
+
+def media_headers(r: httpx.Response) -> dict:
+    # одни и те же заголовки для GET и HEAD: ETag/Last-Modified/Accept-Ranges/Content-Range upstream как есть —
+    # плеер перематывает через Range и не перекачивает трек целиком
+    headers = {k: v for k, v in r.headers.items() if k not in DROP_RESPONSE_HEADERS}
+    headers.setdefault("cache-control", "public, max-age=3600")
+    # X-Accel-Buffering: no — чтобы nginx-подобные прокси Render/Cloudflare не буферизовали весь mp3
+    headers["x-accel-buffering"] = "no"
+    return headers
+
+# /media — стримим байты (mp3) по мере прихода от upstream, не держим весь файл в памяти
+@app.api_route("/media/{filename}", methods=["GET", "HEAD"])
+async def media(filename: str, request: Request):
+    if not _SAFE_NAME.match(filename):
+        raise HTTPException(404, "not found")
+    fwd = {k: v for k in MEDIA_REQUEST_HEADERS if (v := request.headers.get(k))}
+    if "range" in fwd and not range_ok(fwd["range"]):
+        # Content-Range: bytes */<длина> требует размер файла, а его знает только upstream — шлём без него
+        return Response(status_code=416)
+    if request.method == "HEAD":
+        # только заголовки: HEAD и в upstream, тело не качаем
+        try:
+            r = await client.head(u(f"/media/{filename}"), headers=fwd)
+        except Exception as e:
+            raise HTTPException(502, f"upstream_error: {e}")
+        # ошибку — без кэширующих заголовков, как HTTPException у GET (у HEAD тела всё равно нет)
+        if r.status_code not in MEDIA_OK:
+            return Response(status_code=r.status_code)
+        return Response(status_code=r.status_code, headers=media_headers(r))
     try:
-        r = await client.get(u(f"/media/{filename}"))
-        if r.status_code != 200:
-            raise HTTPException(r.status_code, r.text)
-        return StreamingResponse(iter([r.content]), media_type=r.headers.get("content-type", "audio/mpeg"))
+        r = await client.send(client.build_request("GET", u(f"/media/{filename}"), headers=fwd), stream=True)
     except Exception as e:
         raise HTTPException(502, f"upstream_error: {e}")
+    if r.status_code not in MEDIA_OK:
+        body = await r.aread(); await r.aclose()
+        raise HTTPException(r.status_code, body.decode("utf-8", "ignore"))
+    return StreamingResponse(
+        r.aiter_raw(MEDIA_CHUNK),  # сырые байты: без декодера content-encoding и лишних копий
+        status_code=r.status_code,
+        media_type=r.headers.get("content-type", "audio/mpeg"),
+        headers=media_headers(r),
+        background=BackgroundTask(r.aclose),
+    )
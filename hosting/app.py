@@ -1,12 +1,16 @@
 from fastapi import FastAPI, HTTPException, Query, Request
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-import os, re, time, json, sqlite3, threading, base64, subprocess, urllib.request, logging, traceback
+import os, re, time, sqlite3, threading, base64, logging, traceback, asyncio, string, queue
+import contextlib
 from typing import Optional, Union, List, Dict, Any
-from concurrent.futures import ThreadPoolExecutor
-from urllib.parse import parse_qs
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import parse_qsl
 from yt_dlp import YoutubeDL
 from yt_dlp.utils import DownloadError
+import httpx
+import orjson
 import uvicorn
 
 # ---------------- Config ----------------
@@ -17,6 +21,8 @@ CACHE_TTL_SECONDS = int(os.environ.get("CACHE_TTL_SECONDS", str(24 * 3600)))
 CLEANUP_INTERVAL_SECONDS = int(os.environ.get("CLEANUP_INTERVAL_SECONDS", "900"))
 MAX_RESULTS = int(os.environ.get("MAX_RESULTS", "30"))
 PORT = int(os.environ.get("PORT", "8080"))
+DB_FLUSH_INTERVAL = float(os.environ.get("DB_FLUSH_INTERVAL", "0.05"))  # сколько ждать добора пачки
+DB_FLUSH_BATCH = int(os.environ.get("DB_FLUSH_BATCH", "500"))
 
 # Piped fallback instances
 PIPED_INSTANCES: List[str] = [
@@ -28,7 +34,7 @@ PIPED_TIMEOUT = int(os.environ.get("PIPED_TIMEOUT", "25"))
 DB_PATH = os.path.join(MEDIA_ROOT, "history.sqlite3")
 
 # ---------------- App ----------------
-app = FastAPI(title="YouTube MP3 Bridge for MTA")
+app = FastAPI(title="YouTube MP3 Bridge for MTA", default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], allow_methods=["*"], allow_headers=["*"],
@@ -40,8 +46,21 @@ logger.setLevel(logging.INFO)
 logging.basicConfig(level=logging.INFO)
 
 # ---------------- Database ----------------
+def db_connect() -> sqlite3.Connection:
+    # synchronous/busy_timeout/temp_store/cache_size действуют только на своё соединение —
+    # выставляем их каждому, а не один раз в db_init
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")  # ~64 MB page cache
+    return conn
+
 def db_init():
     conn = sqlite3.connect(DB_PATH)
+    # WAL: запись дописывает лог и fsync'ит только его, читатели /status не блокируются.
+    # journal_mode=WAL «липкий» — сохраняется в файле БД и действует для всех последующих соединений.
+    conn.execute("PRAGMA journal_mode=WAL")
     c = conn.cursor()
     c.execute("""
         CREATE TABLE IF NOT EXISTS plays(
@@ -56,25 +75,105 @@ def db_init():
             ts INTEGER NOT NULL, source TEXT
         );
     """)
-    conn.commit(); conn.close()
+    # под выборки по времени (статистика за период) — B-tree вместо полного скана таблицы
+    c.execute("CREATE INDEX IF NOT EXISTS idx_plays_ts ON plays(ts)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pings_ts ON pings(ts)")
+    conn.commit()
+    conn.execute("PRAGMA optimize")
+    conn.close()
 db_init()
 
+# одно соединение на запись (под локом) + по соединению на чтение в каждом потоке:
+# WAL пускает читателей параллельно с писателем, connect() на каждый запрос больше не нужен
+_DB = db_connect()
+_DB_LOCK = threading.Lock()
+_DB_READ = threading.local()
+
+def _db_reader() -> sqlite3.Connection:
+    conn = getattr(_DB_READ, "conn", None)
+    if conn is None:
+        conn = _DB_READ.conn = db_connect()
+    return conn
+
+# plays/pings копятся в очереди, один поток-писатель сливает их пачкой одной транзакцией
+# (executemany): один fsync на пачку вместо одного на строку, запросы не ждут диск
+_WRITE_Q: "queue.Queue[tuple]" = queue.Queue()
+
+# очередь безразмерная — put_nowait не блокирует, можно звать прямо из event loop
 def db_add_play(video_id: str, title: str, nick: str, ip: str, serial: str):
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("INSERT INTO plays(ts, video_id, title, nick, ip, serial) VALUES(?,?,?,?,?,?)",
-                 (int(time.time()), video_id, title, nick, ip, serial))
-    conn.commit(); conn.close()
+    _WRITE_Q.put_nowait(("play", (int(time.time()), video_id, title, nick, ip, serial)))
 
 def db_add_ping(source: str):
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("INSERT INTO pings(ts, source) VALUES(?,?)", (int(time.time()), source))
-    conn.commit(); conn.close()
+    _WRITE_Q.put_nowait(("ping", (int(time.time()), source)))
+
+def db_write_batch(items: List[tuple]):
+    plays = [row for kind, row in items if kind == "play"]
+    pings = [row for kind, row in items if kind == "ping"]
+    with _DB_LOCK:
+        # IMMEDIATE: лок записи берётся сразу и ждёт busy_timeout. Отложенный BEGIN при гонке
+        # с писателем из соседнего воркер-процесса падал бы с SQLITE_BUSY на апгрейде лока
+        _DB.execute("BEGIN IMMEDIATE")
+        try:
+            if plays:
+                _DB.executemany("INSERT INTO plays(ts, video_id, title, nick, ip, serial) VALUES(?,?,?,?,?,?)", plays)
+            if pings:
+                _DB.executemany("INSERT INTO pings(ts, source) VALUES(?,?)", pings)
+            _DB.execute("COMMIT")
+        except Exception:
+            _DB.execute("ROLLBACK"); raise
+
+def db_drain(first: Optional[tuple] = None, wait: float = 0.0) -> List[tuple]:
+    # забрать из очереди до DB_FLUSH_BATCH записей, подождав следующие не дольше wait секунд
+    items = [first] if first else []
+    deadline = time.monotonic() + wait
+    while len(items) < DB_FLUSH_BATCH:
+        try:
+            left = deadline - time.monotonic()
+            items.append(_WRITE_Q.get(timeout=left) if left > 0 else _WRITE_Q.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+def schedule_db_writer():
+    def loop():
+        while True:
+            items = db_drain(_WRITE_Q.get(), DB_FLUSH_INTERVAL)
+            try: db_write_batch(items)
+            except Exception as e: logger.warning("db write failed (%d rows): %s", len(items), e)
+    threading.Thread(target=loop, daemon=True).start()
+schedule_db_writer()
+
+@app.on_event("shutdown")
+def db_shutdown():
+    try:
+        while True:
+            items = db_drain()
+            if not items: break
+            db_write_batch(items)
+    except Exception as e: logger.warning("db flush on shutdown failed: %s", e)
+
+_RECENT_SQL = "SELECT ts, video_id, title, nick, ip, serial FROM plays ORDER BY id DESC LIMIT ?"
+_recent_cache: Dict[int, tuple] = {}  # limit -> (max(id) plays, rows)
 
 def db_recent(limit=50):
-    conn = sqlite3.connect(DB_PATH)
-    rows = conn.execute("SELECT ts, video_id, title, nick, ip, serial FROM plays ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
-    conn.close()
-    return [{"ts": r[0], "video_id": r[1], "title": r[2], "nick": r[3], "ip": r[4], "serial": r[5]} for r in rows]
+    # пока новых plays не было — отдаём уже собранный список без пересборки dict'ов.
+    # Версия — max(id) из самой БД (поиск по rowid, O(log n)): plays пишут оба воркер-процесса,
+    # счётчик в памяти процесса не видел бы чужих вставок
+    version = _db_reader().execute("SELECT max(id) FROM plays").fetchone()[0]
+    hit = _recent_cache.get(limit)
+    if hit and hit[0] == version:
+        return hit[1]
+    rows = _db_reader().execute(_RECENT_SQL, (limit,)).fetchall()
+    out = [{"ts": r[0], "video_id": r[1], "title": r[2], "nick": r[3], "ip": r[4], "serial": r[5]} for r in rows]
+    _recent_cache[limit] = (version, out)
+    return out
+
+def db_optimize():
+    try:
+        with _DB_LOCK:
+            _DB.execute("PRAGMA optimize")
+    except Exception as e:
+        logger.warning("PRAGMA optimize failed: %s", e)
 
 # ---------------- Cookies support (optional) ----------------
 COOKIES_PATH = None
@@ -124,84 +223,443 @@ def ydl_base_opts(player_client: str) -> Dict[str, Any]:
 SEARCH_OPTS = {**ydl_base_opts("android"), "extract_flat": "in_playlist"}  # поиск надёжнее с android
 YDL_INFO_DEFAULT = ydl_base_opts("web")
 
-executor = ThreadPoolExecutor(max_workers=int(os.environ.get("WORKERS", "2")))
+# Конструктор YoutubeDL дорогой (регистрация экстракторов, regex'ы, opener'ы) — переиспользуем экземпляры.
+# Параллельно один экземпляр не используем (yt-dlp мутирует своё состояние), поэтому на набор опций —
+# список свободных: запрос берёт любой, занятые все — создаёт ещё один, а не ждёт соседа.
+# Свободными держим не больше YDL_POOL_SIZE на ключ
+YDL_POOL_SIZE = int(os.environ.get("YDL_POOL_SIZE", "4"))
+_YDL_POOL: Dict[str, List[YoutubeDL]] = {}
+_YDL_POOL_LOCK = threading.Lock()
 
-def mp3_path_for(video_id: str) -> str:
-    return os.path.join(MEDIA_ROOT, f"{video_id}.mp3")
+@contextlib.contextmanager
+def shared_ydl(key: str, make_opts):
+    """YoutubeDL для ключа key на время with-блока; новый экземпляр создаётся лениво из make_opts()."""
+    with _YDL_POOL_LOCK:
+        idle = _YDL_POOL.setdefault(key, [])
+        ydl = idle.pop() if idle else None
+    if ydl is None:
+        ydl = YoutubeDL(make_opts())  # вне лока: создание не тормозит выдачу экземпляров по другим ключам
+    try:
+        yield ydl
+    finally:
+        with _YDL_POOL_LOCK:
+            if len(idle) < YDL_POOL_SIZE: idle.append(ydl)
+
+def ydl_for_client(player_client: str):
+    return shared_ydl(player_client, lambda: ydl_base_opts(player_client))
+
+def warm_ydl_pool():
+    with shared_ydl("search", lambda: SEARCH_OPTS): pass
+    for client in (PLAYER_CLIENTS_WITH_COOKIES if COOKIES_PATH else PLAYER_CLIENTS_NO_COOKIES):
+        with ydl_for_client(client): pass
+
+WORKERS = int(os.environ.get("WORKERS", "2"))
+executor = ThreadPoolExecutor(max_workers=WORKERS)
+# отдельный пул под параллельный опрос player_client: задачи ставятся из потоков executor'а,
+# общий пул при занятых воркерах ждал бы сам себя. Проигравшие гонку клиенты дорабатывают в фоне
+# (поток не прервать) — x2 на них, чтобы опрос следующего vid не вставал в очередь за медленными.
+# Потоки ThreadPoolExecutor создаёт по мере надобности, запас ничего не стоит
+EXTRACT_PARALLEL = os.environ.get("EXTRACT_PARALLEL", "1") == "1"
+_client_executor = ThreadPoolExecutor(max_workers=WORKERS * len(PLAYER_CLIENTS_NO_COOKIES) * 2)
+
+# .m4a появляется только при ALLOW_M4A=1 (AAC от YouTube копируется без перекодирования);
+# по умолчанию всё отдаём в mp3 — MTA-клиенты ждут именно его
+MEDIA_TYPES = {".mp3": "audio/mpeg", ".m4a": "audio/mp4"}
+MEDIA_EXTS = tuple(MEDIA_TYPES)
+ALLOW_M4A = os.environ.get("ALLOW_M4A", "0") == "1"
+
+def media_path_for(video_id: str, ext: str = ".mp3") -> str:
+    return os.path.join(MEDIA_ROOT, f"{video_id}{ext}")
+
+# path -> (mtime, cached_at): горячий /convert не stat'ит файл на каждый запрос
+_FS_CACHE: Dict[str, tuple] = {}
+# через сколько секунд перепроверять закэшированный mtime: файлы может менять соседний воркер-процесс
+FS_CACHE_TTL = int(os.environ.get("FS_CACHE_TTL", "60"))
+
+def file_mtime(path: str) -> Optional[float]:
+    now = time.time()
+    hit = _FS_CACHE.get(path)
+    if hit and now - hit[1] < FS_CACHE_TTL:
+        return hit[0]
+    try: mtime = os.stat(path).st_mtime
+    except OSError:
+        _FS_CACHE.pop(path, None); return None
+    _FS_CACHE[path] = (mtime, now)
+    return mtime
 
 def is_fresh(path: str) -> bool:
-    return os.path.exists(path) and (time.time() - os.path.getmtime(path) < CACHE_TTL_SECONDS)
+    mtime = file_mtime(path)
+    return mtime is not None and (time.time() - mtime < CACHE_TTL_SECONDS)
+
+def fresh_media_path(video_id: str) -> Optional[str]:
+    for ext in (MEDIA_EXTS if ALLOW_M4A else (".mp3",)):
+        path = media_path_for(video_id, ext)
+        if is_fresh(path):
+            # при бюджете файл мог вытеснить соседний процесс — его _FS_CACHE об этом не знает.
+            # Проверяем только попадание (один stat), промах и так уходит в stat после FS_CACHE_TTL
+            if MAX_CACHE_BYTES > 0 and not os.path.exists(path):
+                _FS_CACHE.pop(path, None); continue
+            return path
+    return None
+
+# LRU по суммарному размеру: path -> size, порядок — от давно не игравших к свежим.
+# MAX_CACHE_BYTES=0 — бюджет выключен: ни списка обращений, ни utime, только уборка по CACHE_TTL_SECONDS.
+# Каталог общий для воркер-процессов, а список у каждого свой: перед вытеснением он пересобирается с диска
+MAX_CACHE_BYTES = int(os.environ.get("MAX_CACHE_BYTES", "0"))
+TOUCH_INTERVAL = 3600  # utime не чаще раза в час на файл — Range-запросы плеера не дёргают диск
+_LRU: "OrderedDict[str, int]" = OrderedDict()
+_LRU_LOCK = threading.Lock()
+_lru_bytes = 0
+# пересборка списка и unlink'и — в своём потоке: lru_add зовётся из event loop после ffmpeg
+_evict_executor = ThreadPoolExecutor(max_workers=1)
+_EVICT_PENDING = threading.Event()  # вытеснение уже в очереди — новые файлы его не дублируют
+
+def lru_load():
+    # scandir каталога: размеры и порядок по mtime (при старте и перед каждым вытеснением);
+    # заодно прогреваем _FS_CACHE — первые /convert по уже скачанным трекам не stat'ят файл
+    global _lru_bytes
+    now = time.time()
+    entries = []
+    with os.scandir(MEDIA_ROOT) as it:
+        for e in it:
+            if e.name.endswith(MEDIA_EXTS):
+                try: st = e.stat()
+                except OSError: continue
+                entries.append((st.st_mtime, e.path, st.st_size))
+                _FS_CACHE[e.path] = (st.st_mtime, now)
+    with _LRU_LOCK:
+        _LRU.clear()
+        for _, path, size in sorted(entries):
+            _LRU[path] = size
+        _lru_bytes = sum(_LRU.values())
+
+def lru_add(path: str):
+    # файл только что записан ffmpeg'ом — учесть размер и при превышении бюджета вытеснить старые
+    global _lru_bytes
+    try: st = os.stat(path)
+    except OSError:
+        _FS_CACHE.pop(path, None); return
+    _FS_CACHE[path] = (st.st_mtime, time.time())  # mtime известен — следующий /convert обойдётся без stat
+    size = st.st_size
+    with _LRU_LOCK:
+        _lru_bytes += size - _LRU.pop(path, 0)
+        _LRU[path] = size
+    lru_evict_soon()
+
+def lru_touch(path: str):
+    # обращение к файлу: в конец LRU + свежий mtime, чтобы популярный трек не протухал по TTL
+    if MAX_CACHE_BYTES <= 0: return
+    with _LRU_LOCK:
+        if path in _LRU: _LRU.move_to_end(path)
+    mtime = file_mtime(path)
+    now = time.time()
+    if mtime is not None and now - mtime > TOUCH_INTERVAL:
+        try: os.utime(path, None)
+        except OSError: return
+        _FS_CACHE[path] = (now, now)
+
+def lru_evict_soon():
+    if MAX_CACHE_BYTES <= 0 or _EVICT_PENDING.is_set(): return
+    _EVICT_PENDING.set()
+    _evict_executor.submit(_evict_job)
+
+def _evict_job():
+    _EVICT_PENDING.clear()  # до пересборки: файл, дописанный во время неё, поставит следующую
+    lru_evict()
+
+def lru_evict():
+    # блокирующая (scandir + unlink) — только из фоновых потоков.
+    # Свой счётчик не видит файлов соседнего процесса и удалённых им — считаем заново по диску;
+    # порядок — по mtime, lru_touch обновляет его раз в TOUCH_INTERVAL
+    global _lru_bytes
+    lru_load()
+    if MAX_CACHE_BYTES <= 0: return
+    victims = []
+    with _LRU_LOCK:
+        while _lru_bytes > MAX_CACHE_BYTES and len(_LRU) > 1:
+            path, size = _LRU.popitem(last=False)
+            _lru_bytes -= size; victims.append(path)
+    for path in victims:
+        try: os.unlink(path)
+        except OSError: pass
+        _FS_CACHE.pop(path, None)
+
+def lru_forget(path: str):
+    global _lru_bytes
+    with _LRU_LOCK:
+        _lru_bytes -= _LRU.pop(path, 0)
 
 def cleanup_old_files():
     now = time.time()
-    for name in os.listdir(MEDIA_ROOT):
-        if name.endswith(".mp3"):
-            p = os.path.join(MEDIA_ROOT, name)
-            if (now - os.path.getmtime(p)) > CACHE_TTL_SECONDS:
-                try: os.remove(p)
-                except Exception: pass
+    with os.scandir(MEDIA_ROOT) as it:
+        for e in it:
+            # <vid>.mp3.<pid>.part от процесса, убитого посреди ffmpeg (рестарт, OOM), — finally там не отработал.
+            # Живой ffmpeg дописывает свой .part постоянно, его mtime свежий
+            if e.name.endswith(".part"):
+                try:
+                    if now - e.stat().st_mtime > FFMPEG_TIMEOUT: os.unlink(e.path)
+                except OSError:
+                    pass
+                continue
+            if not e.name.endswith(MEDIA_EXTS):
+                continue
+            # файл могли удалить/перезаписать параллельно — stat() бросит, поток уборки не должен умереть
+            try:
+                if (now - e.stat().st_mtime) <= CACHE_TTL_SECONDS:
+                    continue
+                os.unlink(e.path)
+            except OSError:
+                pass
+            _FS_CACHE.pop(e.path, None); lru_forget(e.path)
+    for p, (_, cached_at) in list(_FS_CACHE.items()):
+        if now - cached_at > CLEANUP_INTERVAL_SECONDS:
+            _FS_CACHE.pop(p, None)
 
 def schedule_cleanup():
     def loop():
+        lru_evict()  # стартовая загрузка списка с диска (и вытеснение сверх бюджета) — не в event loop
         while True:
-            cleanup_old_files(); time.sleep(CLEANUP_INTERVAL_SECONDS)
+            cleanup_old_files(); prune_stream_caches(); db_optimize(); time.sleep(CLEANUP_INTERVAL_SECONDS)
     threading.Thread(target=loop, daemon=True).start()
-schedule_cleanup()
+
+@app.on_event("startup")
+def start_cleanup():
+    # стартуем после импорта всего модуля: цикл зовёт хелперы, объявленные ниже
+    schedule_cleanup()
+    # YoutubeDL создаём заранее в фоне, чтобы первый /search или /convert не платил за инициализацию
+    executor.submit(warm_ydl_pool)
 
 # ---------- YouTube helpers ----------
-YOUTUBE_ID_RE = re.compile(r"^[0-9A-Za-z_-]{5,20}$")
-YOUTUBE_URL_RE = re.compile(r"(?:youtu\.be/|youtube\.com/(?:watch\?v=|shorts/|live/))([0-9A-Za-z_-]{5,20})")
+# голый ID или ссылка youtu.be / youtube.com — одна скомпилированная альтернатива вместо двух regex
+YOUTUBE_VID_RE = re.compile(
+    r"(?:^(?P<id>[0-9A-Za-z_-]{5,20})$)"
+    r"|(?:youtu\.be/|youtube\.com/(?:watch\?v=|shorts/|live/))(?P<url_id>[0-9A-Za-z_-]{5,20})"
+)
+
+_VID_CHARS = frozenset(string.ascii_letters + string.digits + "_-")
 
 def extract_video_id(candidate: str) -> Optional[str]:
     candidate = (candidate or "").strip()
-    if YOUTUBE_ID_RE.fullmatch(candidate): return candidate
-    m = YOUTUBE_URL_RE.search(candidate);  return m.group(1) if m else None
-
-def pick_best_audio_from_formats(formats) -> Optional[str]:
-    best_url, best_abr = None, -1
-    for f in formats or []:
-        vcodec = f.get("vcodec"); acodec = f.get("acodec"); url = f.get("url")
-        if url and (vcodec in (None, "none")) and (acodec not in (None, "none")):
-            abr = f.get("abr") or 0
-            try: abr = int(abr)
-            except: abr = 0
-            if abr > best_abr:
-                best_abr, best_url = abr, url
-    return best_url
-
-def ffmpeg_transcode_to_mp3(input_url: str, target_path: str) -> bool:
+    # обычный YouTube ID — 11 символов из [0-9A-Za-z_-]: проверяем без regex
+    if len(candidate) == 11 and _VID_CHARS.issuperset(candidate): return candidate
+    m = YOUTUBE_VID_RE.search(candidate)
+    return (m.group("id") or m.group("url_id")) if m else None
+
+def audio_only_formats(formats) -> List[dict]:
+    """audio-only дорожки с прямым URL — общий фильтр для выбора лучшей и для /diag*."""
+    out = []
+    for f in formats or ():
+        get = f.get
+        if get("url") and get("vcodec") in (None, "none") and get("acodec") not in (None, "none"):
+            out.append(f)
+    return out
+
+def pick_best_audio_from_formats(formats) -> Optional[tuple]:
+    """Возвращает (url, acodec, http_headers) лучшей audio-only дорожки или None."""
+    best, best_abr = None, -1
+    for f in audio_only_formats(formats):
+        abr = f.get("abr") or 0
+        try: abr = int(abr)
+        except: abr = 0
+        if abr > best_abr:
+            best_abr, best = abr, f
+    return (best["url"], best["acodec"], best.get("http_headers") or {}) if best else None
+
+# LAME VBR (-q:a 4 = -V4, ~130-165 kbps) вместо CBR 192k: кодирует быстрее при том же
+# воспринимаемом качестве уже сжатых YouTube-дорожек. MP3_QUALITY: 0 — лучше, 9 — меньше
+MP3_QUALITY = os.environ.get("MP3_QUALITY", "4")
+# -compression_level = алгоритмическое качество LAME (-q): 0 — медленно, 9 — быстро; по умолчанию у LAME 3.
+# 5 заметно быстрее при неотличимом на слух результате. -threads 1: LAME однопоточный, пул ffmpeg не нужен
+MP3_COMPRESSION_LEVEL = os.environ.get("MP3_COMPRESSION_LEVEL", "5")
+MP3_ENCODE_ARGS = ["-acodec","libmp3lame","-q:a",MP3_QUALITY,"-compression_level",MP3_COMPRESSION_LEVEL,"-threads","1"]
+
+FFMPEG_STDERR_TAIL = 4096
+
+# когда ffmpeg сам качает URL (googlevideo): переподключение при обрыве,
+# минимальный пробинг — у audio-only дорожек параметры кодека в заголовке
+FFMPEG_HTTP_ARGS = ["-reconnect","1","-reconnect_streamed","1","-reconnect_delay_max","5",
+                    "-probesize","32k","-analyzeduration","0"]
+
+def ffmpeg_http_args(headers: Optional[Dict[str, str]] = None) -> List[str]:
+    # заголовки формата от yt-dlp: ссылки android/ios-клиентов привязаны к их User-Agent,
+    # без него googlevideo отвечает 403 и /convert уходит в медленный фолбэк на Piped
+    headers = dict(headers or {})
+    args = ["-user_agent", headers.pop("User-Agent", UA)]
+    if headers:
+        args += ["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())]
+    return args + FFMPEG_HTTP_ARGS
+
+async def _stderr_tail(stream) -> bytes:
+    # читаем stderr кусками и держим только хвост — память не растёт на длинных/болтливых прогонах
+    tail = bytearray()
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk: return bytes(tail)
+        tail += chunk
+        del tail[:-FFMPEG_STDERR_TAIL]
+
+# явный мьюксер: выход пишется во временный .part, по расширению ffmpeg формат не угадает
+FFMPEG_MUXERS = {".mp3": "mp3", ".m4a": "ipod"}
+FFMPEG_TIMEOUT = 600  # дольше ffmpeg не живёт: .part старше этого — остаток убитого процесса, его сносит уборка
+
+async def _run_ffmpeg(cmd: List[str], target_path: str, feed=None) -> bool:
+    """
+    Запускает ffmpeg асинхронно (event loop не стоит, пока идёт кодирование).
+    cmd — без выходного файла: пишем во временный файл и атомарно переименовываем в target_path,
+    так что второй воркер-процесс или /media никогда не видят недописанный/обрезанный файл.
+    feed(stdin) — опциональная корутина, которая пишет входные данные в stdin процесса.
+    """
     os.makedirs(os.path.dirname(target_path), exist_ok=True)
-    cmd = ["ffmpeg","-y","-i",input_url,"-vn","-acodec","libmp3lame","-b:a","192k", target_path]
+    tmp_path = f"{target_path}.{os.getpid()}.part"
+    muxer = FFMPEG_MUXERS[os.path.splitext(target_path)[1]]
+    proc = None
     try:
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=600)
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, "-f", muxer, tmp_path, stdin=asyncio.subprocess.PIPE if feed else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE, limit=1 << 20)
+        jobs = [_stderr_tail(proc.stderr), proc.wait()]
+        if feed:
+            jobs.append(feed(proc.stdin))
+        err = (await asyncio.wait_for(asyncio.gather(*jobs), timeout=FFMPEG_TIMEOUT))[0]
         if proc.returncode != 0:
-            logger.warning("ffmpeg stderr: %s", proc.stderr.decode("utf-8","ignore")[-400:])
-        return proc.returncode == 0
+            logger.warning("ffmpeg stderr: %s", err.decode("utf-8","ignore")[-400:])
+            return False
+        os.replace(tmp_path, target_path)
+        lru_add(target_path)  # обновит и закэшированный mtime перезаписанного файла
+        return True
     except Exception as e:
+        if proc and proc.returncode is None:
+            proc.kill(); await proc.wait()
         logger.warning("ffmpeg failed: %s", e); return False
+    finally:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_path)
 
-def piped_best_audio_url(video_id: str) -> Optional[str]:
-    for base in PIPED_INSTANCES:
-        try:
-            url = f"{base.rstrip('/')}/api/v1/streams/{video_id}"
-            req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
-            with urllib.request.urlopen(req, timeout=PIPED_TIMEOUT) as resp:
-                if resp.status != 200:
-                    continue
-                data = json.loads(resp.read().decode("utf-8","ignore"))
-                streams = data.get("audioStreams") or []
-                best = None; best_rate = -1
-                for s in streams:
-                    try: rate = int(s.get("bitrate") or s.get("bitrateKbps") or 0)
-                    except: rate = 0
-                    if s.get("url") and rate > best_rate:
-                        best_rate, best = rate, s
-                if best and best.get("url"):
-                    return best["url"]
-        except Exception as e:
-            logger.warning("piped fail on %s: %s", base, e)
+async def ffmpeg_transcode_to_mp3(input_url: str, target_path: str, headers: Optional[Dict[str, str]] = None) -> bool:
+    cmd = ["ffmpeg","-y","-hide_banner","-loglevel","error","-nostdin",*ffmpeg_http_args(headers),"-i",input_url,"-vn",*MP3_ENCODE_ARGS]
+    return await _run_ffmpeg(cmd, target_path)
+
+def m4a_copy_ok(acodec: str) -> bool:
+    return ALLOW_M4A and (acodec or "").startswith(("mp4a", "aac"))
+
+async def ffmpeg_copy_to_m4a(input_url: str, target_path: str, headers: Optional[Dict[str, str]] = None) -> bool:
+    # AAC как есть в m4a: ни декодирования, ни LAME — упирается только в сеть
+    cmd = ["ffmpeg","-y","-hide_banner","-loglevel","error","-nostdin",*ffmpeg_http_args(headers),"-i",input_url,"-vn","-c:a","copy","-movflags","+faststart"]
+    return await _run_ffmpeg(cmd, target_path)
+
+# общий async-клиент для Piped: keep-alive/HTTP2 между фолбэками, event loop не блокируется
+# keepalive_expiry с запасом: фолбэк на Piped бывает редко, но TLS к инстансам дорогой
+PIPED_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=8, keepalive_expiry=120)
+_piped_client = httpx.AsyncClient(timeout=PIPED_TIMEOUT, http2=True, limits=PIPED_LIMITS, headers={"User-Agent": "Mozilla/5.0"})
+
+PIPED_CONCURRENCY = int(os.environ.get("PIPED_CONCURRENCY", "4"))
+_piped_sems: Dict[str, asyncio.Semaphore] = {}  # по семафору на инстанс Piped
+
+async def piped_stream_info(base: str, video_id: str) -> Optional[Dict[str, Any]]:
+    sem = _piped_sems.get(base) or _piped_sems.setdefault(base, asyncio.Semaphore(PIPED_CONCURRENCY))
+    async with sem:
+        r = await _piped_client.get(f"{base.rstrip('/')}/api/v1/streams/{video_id}")
+    if r.status_code != 200:
+        return None
+    # orjson по байтам: ответ /streams — сотни КБ метаданных, stdlib json на нём заметно медленнее
+    return orjson.loads(r.content)
+
+def piped_pick_audio(data: Dict[str, Any]) -> Optional[tuple]:
+    """(url, codec, kbps) дорожки с максимальным битрейтом из ответа /streams."""
+    best = None; best_rate = -1
+    for s in data.get("audioStreams") or []:
+        try: rate = int(s.get("bitrate") or s.get("bitrateKbps") or 0)
+        except: rate = 0
+        if s.get("url") and rate > best_rate:
+            best_rate, best = rate, s
+    if not best:
+        return None
+    codec = (best.get("codec") or best.get("mimeType") or "").lower()
+    kbps = best_rate // 1000 if best_rate >= 1000 else best_rate  # Piped отдаёт bitrate в bps
+    return best["url"], codec, kbps
+
+# base -> (подряд ошибок, не трогать до ts): хронически лежащие инстансы пропускаем с экспоненциальной паузой
+PIPED_BACKOFF_BASE = 30
+PIPED_BACKOFF_MAX = 900
+_piped_failures: Dict[str, tuple] = {}
+
+def piped_available(base: str) -> bool:
+    entry = _piped_failures.get(base)
+    return not entry or time.time() >= entry[1]
+
+def piped_mark(base: str, ok: bool):
+    if ok:
+        _piped_failures.pop(base, None); return
+    fails = _piped_failures.get(base, (0, 0))[0] + 1
+    _piped_failures[base] = (fails, time.time() + min(PIPED_BACKOFF_MAX, PIPED_BACKOFF_BASE * 2 ** (fails - 1)))
+
+async def _piped_probe(base: str, video_id: str) -> Optional[tuple]:
+    # не-200 (502 от перегруженного инстанса, 500 «Could not extract») и 200 с мусором вместо
+    # объекта (JSON-строка "Video unavailable") — отказ инстанса; остальные пробы идут дальше
+    try:
+        data = await piped_stream_info(base, video_id)
+        if not isinstance(data, dict):
+            raise ValueError(f"bad /streams answer: {str(data)[:80]}")
+        best = piped_pick_audio(data)
+    except Exception as e:
+        logger.warning("piped fail on %s: %s", base, e)
+        piped_mark(base, False); return None
+    piped_mark(base, True)
+    return best
+
+async def piped_best_audio_url(video_id: str) -> Optional[tuple]:
+    """
+    Возвращает (url, codec, kbps) лучшей аудио-дорожки или None.
+    Все инстансы опрашиваются параллельно, побеждает первый ответивший с аудио —
+    задержка равна самому быстрому живому инстансу, а не сумме таймаутов.
+    """
+    # параллельные запросы на один vid уже схлопнуты single_flight в /convert — хватит простого TTL-кэша
+    cached = _cache_get(_PIPED_CACHE, video_id)
+    if cached: return cached
+    bases = [b for b in PIPED_INSTANCES if piped_available(b)] or PIPED_INSTANCES
+    tasks = [asyncio.create_task(_piped_probe(b, video_id)) for b in bases]
+    try:
+        for fut in asyncio.as_completed(tasks, timeout=PIPED_TIMEOUT):
+            best = await fut
+            if best:
+                _PIPED_CACHE[video_id] = (time.time(), best)
+                return best
+    except asyncio.TimeoutError:
+        logger.warning("piped: no instance answered in %ss", PIPED_TIMEOUT)
+    finally:
+        for t in tasks: t.cancel()
     return None
 
+MP3_COPY_MIN_KBPS = int(os.environ.get("MP3_COPY_MIN_KBPS", "128"))
+
+def mp3_copy_ok(codec: str, kbps: int) -> bool:
+    # источник уже mp3 приличного битрейта — перекодировать LAME'ом нечего, хватит -c:a copy
+    return ("mp3" in codec or "mpeg" in codec) and kbps >= MP3_COPY_MIN_KBPS
+
+async def ffmpeg_transcode_stream_to_mp3(audio_url: str, target_path: str, copy: bool = False) -> bool:
+    """
+    Качает аудио тем же (уже прогретым) httpx-клиентом и подаёт в ffmpeg через stdin:
+    сеть и LAME-кодирование идут параллельно, ffmpeg не открывает своё HTTP-соединение.
+    copy=True — источник уже mp3, поток копируется без перекодирования.
+    """
+    async def feed(stdin):
+        try:
+            async with _piped_client.stream("GET", audio_url) as r:
+                r.raise_for_status()
+                async for chunk in r.aiter_bytes(65536):
+                    stdin.write(chunk); await stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg завершился раньше — код возврата расскажет, почему
+        finally:
+            stdin.close()
+    codec_args = ["-c:a","copy"] if copy else MP3_ENCODE_ARGS
+    cmd = ["ffmpeg","-y","-hide_banner","-loglevel","error","-i","pipe:0","-vn",*codec_args]
+    return await _run_ffmpeg(cmd, target_path, feed)
+
+@app.on_event("shutdown")
+async def piped_shutdown():
+    await _piped_client.aclose()
+
 def env_ytdl_vars() -> Dict[str, str]:
     out = {}
     for k, v in os.environ.items():
@@ -209,40 +667,179 @@ def env_ytdl_vars() -> Dict[str, str]:
             out[k] = v if len(v) < 200 else (v[:200] + "...(truncated)")
     return out
 
-def try_extract_info_with_clients(video_id: str) -> Optional[str]:
+def _extract_with_client(client: str, video_id: str) -> Optional[tuple]:
+    try:
+        fmts = ydl_formats(client, video_id)
+        logger.info("extract with client=%s: formats_total=%d", client, len(fmts))
+        picked = pick_best_audio_from_formats(fmts)
+        if picked:
+            logger.info("extract with client=%s: picked audio acodec=%s", client, picked[1])
+        return picked
+    except Exception as e:
+        logger.warning("extract failed client=%s: %s", client, str(e).splitlines()[-1])
+        return None
+
+def try_extract_info_with_clients(video_id: str) -> Optional[tuple]:
     """
-    Пытаемся получить URL лучшей аудио-дорожки, перебирая разные player_client.
-    Возвращает прямой URL потока или None.
+    Пытаемся получить URL лучшей аудио-дорожки от разных player_client.
+    EXTRACT_PARALLEL=1 — все клиенты опрашиваются разом, побеждает первый с аудио:
+    задержка = самый быстрый клиент, а не сумма таймаутов медленных. 0 — по очереди, как раньше.
+    Возвращает (прямой URL потока, acodec, http_headers) или None.
     """
-    url = f"https://www.youtube.com/watch?v={video_id}"
-    has_cookies = bool(COOKIES_PATH)
-    order = PLAYER_CLIENTS_WITH_COOKIES if has_cookies else PLAYER_CLIENTS_NO_COOKIES
+    order = PLAYER_CLIENTS_WITH_COOKIES if COOKIES_PATH else PLAYER_CLIENTS_NO_COOKIES
+    if not EXTRACT_PARALLEL:
+        for client in order:
+            picked = _extract_with_client(client, video_id)
+            if picked: return picked
+        return None
+    pending = {_client_executor.submit(_extract_with_client, client, video_id) for client in order}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            picked = fut.result()
+            if picked:
+                # ещё не стартовавшие отменяются, уже идущие доработают в фоне — поток не прервать
+                for rest in pending: rest.cancel()
+                return picked
+    return None
 
-    for client in order:
-        opts = ydl_base_opts(client)
-        try:
-            with YoutubeDL(opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-            fmts = (info or {}).get("formats") or []
-            logger.info("extract with client=%s: formats_total=%d", client, len(fmts))
-            stream_url = pick_best_audio_from_formats(fmts)
-            if stream_url:
-                logger.info("extract with client=%s: picked audio", client)
-                return stream_url
-        except Exception as e:
-            logger.warning("extract failed client=%s: %s", client, str(e).splitlines()[-1])
-            continue
+# ---------- Stream URL cache ----------
+# vid -> (ts, результат): повторный /convert (истёкший mp3, параллельный запрос) в пределах TTL
+# не ходит в YouTube/Piped заново; после ffmpeg_failed ссылка выкидывается (forget_stream).
+# Прямые ссылки googlevideo живут часами, 5 минут — с запасом
+STREAM_CACHE_TTL = int(os.environ.get("STREAM_CACHE_TTL", "300"))
+_EXTRACT_CACHE: Dict[str, tuple] = {}
+_PIPED_CACHE: Dict[str, tuple] = {}
+_EXTRACT_LOCKS: Dict[str, threading.Lock] = {}
+_EXTRACT_LOCKS_GUARD = threading.Lock()
+
+def _cache_get(cache: Dict[str, tuple], key: str):
+    hit = cache.get(key)
+    if hit and time.time() - hit[0] < STREAM_CACHE_TTL:
+        return hit[1]
     return None
 
+# "client:vid" -> (ts, formats): /diag, /diag_clients и повторные extract'ы в пределах TTL
+# не качают watch-страницу заново. Держим только formats, не весь info — он в разы тяжелее
+FORMATS_CACHE_MAX = 64
+_FORMATS_CACHE: Dict[str, tuple] = {}
+_FORMATS_LOCK = threading.Lock()
+
+def ydl_formats(client: str, video_id: str) -> List[dict]:
+    key = f"{client}:{video_id}"
+    fmts = _cache_get(_FORMATS_CACHE, key)
+    if fmts is not None: return fmts
+    with ydl_for_client(client) as ydl:
+        info = ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False)
+    fmts = (info or {}).get("formats") or []
+    with _FORMATS_LOCK:
+        _FORMATS_CACHE[key] = (time.time(), fmts)
+        while len(_FORMATS_CACHE) > FORMATS_CACHE_MAX:
+            _FORMATS_CACHE.pop(next(iter(_FORMATS_CACHE)), None)
+    return fmts
+
+def extract_audio_cached(video_id: str) -> Optional[tuple]:
+    """try_extract_info_with_clients с TTL-кэшем; параллельные вызовы на один vid делят один extract."""
+    picked = _cache_get(_EXTRACT_CACHE, video_id)
+    if picked: return picked
+    with _EXTRACT_LOCKS_GUARD:
+        lock = _EXTRACT_LOCKS.setdefault(video_id, threading.Lock())
+    with lock:
+        picked = _cache_get(_EXTRACT_CACHE, video_id)
+        if not picked:
+            picked = try_extract_info_with_clients(video_id)
+            if picked: _EXTRACT_CACHE[video_id] = (time.time(), picked)
+    return picked
+
+def forget_stream(video_id: str):
+    # ffmpeg не смог скачать по ссылке (403, протухла) — ретрай должен получить свежую, а не ту же из кэша
+    _EXTRACT_CACHE.pop(video_id, None)
+    _PIPED_CACHE.pop(video_id, None)
+    with _FORMATS_LOCK:
+        for k in [k for k in _FORMATS_CACHE if k.endswith(":" + video_id)]:
+            _FORMATS_CACHE.pop(k, None)
+
+def prune_stream_caches():
+    now = time.time()
+    for cache in (_EXTRACT_CACHE, _PIPED_CACHE, _FORMATS_CACHE):
+        for k, (ts, _) in list(cache.items()):
+            if now - ts >= STREAM_CACHE_TTL: cache.pop(k, None)
+    with _EXTRACT_LOCKS_GUARD:
+        for k, lock in list(_EXTRACT_LOCKS.items()):
+            if not lock.locked(): _EXTRACT_LOCKS.pop(k, None)
+
+# не больше CONVERT_CONCURRENCY одновременных yt-dlp/ffmpeg: CPU не трэшится, YouTube/Piped реже отвечают 429.
+# по умолчанию = WORKERS: больше слотов всё равно упрётся в очередь executor'а на extract_info.
+# Семафор — на процесс: всего одновременных ffmpeg до WEB_CONCURRENCY × CONVERT_CONCURRENCY
+CONVERT_CONCURRENCY = int(os.environ.get("CONVERT_CONCURRENCY", str(WORKERS)))
+_CONVERT_SEM = asyncio.Semaphore(CONVERT_CONCURRENCY)
+
+# ---------- Single-flight ----------
+# vid -> [asyncio.Lock, число ожидающих]: одинаковые /convert не качают и не пишут один mp3 дважды.
+# Только внутри процесса: соседний воркер-процесс может параллельно перекодировать тот же vid —
+# лишняя работа, но не битый файл (у каждого свой .<pid>.part, os.replace атомарен)
+_INFLIGHT: Dict[str, list] = {}
+
+@contextlib.asynccontextmanager
+async def single_flight(key: str):
+    entry = _INFLIGHT.get(key)
+    if entry is None:
+        entry = _INFLIGHT[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]: _INFLIGHT.pop(key, None)
+
+# ---------- /convert input ----------
+# поле -> допустимые ключи в JSON, по приоритету
+KEY_ALIASES: Dict[str, tuple] = {
+    "video_id": ("video_id", "videoId", "id", "url"),
+    "title": ("title",),
+    "nick": ("nick", "nickname", "user"),
+    "ip": ("ip",),
+    "serial": ("serial", "serialNumber"),
+}
+NESTED_KEYS = ("data", "payload", "body")
+
+def extract_fields(d: dict) -> Dict[str, str]:
+    """
+    Все поля за один проход, первое непустое значение побеждает
+    (сначала верхний уровень, затем вложенные data/payload/body в глубину).
+    Вложенность разворачивается стеком в плоский список узлов — без рекурсии.
+    """
+    nodes, stack = [], [d]
+    while stack:
+        node = stack.pop(); nodes.append(node)
+        stack.extend(reversed([node[n] for n in NESTED_KEYS if isinstance(node.get(n), dict)]))
+    out: Dict[str, str] = {}
+    for field, keys in KEY_ALIASES.items():
+        v = next((node[k] for node in nodes for k in keys if node.get(k)), None)
+        if v: out[field] = str(v)
+    return out
+
 # ---------------- Endpoints ----------------
 @app.get("/ping")
-def ping(source: str = "mta"):
+async def ping(source: str = "mta"):
     db_add_ping(source); return {"ok": True, "ts": int(time.time()), "source": source}
 
+# (q.lower(), limit) -> (ts, items): повторный поиск в пределах TTL не ходит в YouTube
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", "600"))
+SEARCH_CACHE_MAX = 512
+_search_cache: Dict[tuple, tuple] = {}
+_search_cache_lock = threading.Lock()
+
 @app.get("/search")
 def search(q: str = Query(..., min_length=1), limit: int = MAX_RESULTS):
-    query = f"ytsearch{min(limit, MAX_RESULTS)}:{q}"
-    with YoutubeDL(SEARCH_OPTS) as ydl:
+    limit = min(limit, MAX_RESULTS)
+    key = (q.lower(), limit)
+    hit = _search_cache.get(key)
+    if hit and time.time() - hit[0] < SEARCH_CACHE_TTL:
+        return {"query": q, "count": len(hit[1]), "items": hit[1]}
+    query = f"ytsearch{limit}:{q}"
+    with shared_ydl("search", lambda: SEARCH_OPTS) as ydl:
         info = ydl.extract_info(query, download=False)
     entries = info.get("entries", []) if info else []
     results = []
@@ -252,6 +849,11 @@ def search(q: str = Query(..., min_length=1), limit: int = MAX_RESULTS):
         dur = e.get("duration"); ch = e.get("channel") or e.get("uploader")
         url = f"https://www.youtube.com/watch?v={vid}"
         results.append({"id": vid, "title": title, "duration": dur, "channel": ch, "url": url})
+    with _search_cache_lock:
+        _search_cache.pop(key, None)
+        _search_cache[key] = (time.time(), results)
+        while len(_search_cache) > SEARCH_CACHE_MAX:
+            _search_cache.pop(next(iter(_search_cache)))  # dict хранит порядок вставки — первым уходит самый старый
     return {"query": q, "count": len(results), "items": results}
 
 @app.post("/convert")
@@ -261,41 +863,44 @@ async def convert(request: Request):
     qp = request.query_params
     ctype = (request.headers.get("content-type") or "").lower()
     data: Union[dict, list, str] = {}
-    try:
-        data = await request.json()
-        if isinstance(data, str):
-            data = json.loads(data)
-    except Exception:
-        pass
-    if isinstance(data, dict):
-        def pick(d,*ks):
-            for k in ks:
-                if d.get(k): return str(d[k])
-            for nest in ("data","payload","body"):
-                if isinstance(d.get(nest), dict):
-                    v = pick(d[nest], *ks)
-                    if v: return v
-            return ""
-        vid = pick(data,"video_id","videoId","id","url") or ""
-        title = pick(data,"title") or ""
-        nick = pick(data,"nick","nickname","user") or ""
-        ip = pick(data,"ip") or ""
-        serial = pick(data,"serial","serialNumber") or ""
-    # form/raw
-    if not vid:
-        raw = await request.body()
+    # тело читаем один раз; JSON пробуем, только если на него похоже (content-type/первый байт)
+    raw = (await request.body()).strip()
+    if raw and ("json" in ctype or raw[:1] in b'{["'):
+        try:
+            # orjson напрямую по байтам: Request.json() внутри использует stdlib json
+            data = orjson.loads(raw)
+            if isinstance(data, str):
+                data = orjson.loads(data)
+        except Exception:
+            pass
+    if isinstance(data, list):
+        # toJSON из MTA заворачивает аргументы в массив: [ {...} ] или [ "ссылка" ]
+        data = next((x for x in data if isinstance(x, (dict, str))), {})
+    if isinstance(data, str):
+        vid = data  # тело — JSON-строка с самим ID/ссылкой
+    elif isinstance(data, dict) and data:
+        fields = extract_fields(data)
+        vid = fields.get("video_id", "")
+        title = fields.get("title", "")
+        nick = fields.get("nick", "")
+        ip = fields.get("ip", "")
+        serial = fields.get("serial", "")
+    # form/raw: JSON не дал ID (форма или голый ID под json content-type, массив от toJSON со ссылкой)
+    if not vid and raw:
         if b"&" in raw or "application/x-www-form-urlencoded" in ctype:
             try:
-                form = parse_qs(raw.decode("utf-8","ignore"))
-                vid = (form.get("video_id",[""])[0] or form.get("videoId",[""])[0] or form.get("id",[""])[0] or form.get("url",[""])[0])
-                title = title or form.get("title",[""])[0]
-                nick = nick or form.get("nick",[""])[0]
-                ip = ip or form.get("ip",[""])[0]
-                serial = serial or form.get("serial",[""])[0]
+                # parse_qsl + dict: сразу скалярные значения, без списков из одного элемента
+                form = dict(parse_qsl(raw.decode("utf-8","ignore"), keep_blank_values=True))
+                vid = form.get("video_id") or form.get("videoId") or form.get("id") or form.get("url") or ""
+                title = title or form.get("title", "")
+                nick = nick or form.get("nick", "")
+                ip = ip or form.get("ip", "")
+                serial = serial or form.get("serial", "")
             except Exception:
                 pass
-        elif raw:
-            vid = raw.decode("utf-8","ignore").strip()
+        else:
+            # extract_video_id ищет ссылку youtu.be/youtube.com в любом месте текста, в т.ч. внутри ["..."]
+            vid = raw.decode("utf-8","ignore")
     # query fallback
     if not vid:
         vid = qp.get("video_id") or qp.get("id") or qp.get("url") or ""
@@ -304,33 +909,53 @@ async def convert(request: Request):
         ip = ip or qp.get("ip") or ""
         serial = serial or qp.get("serial") or ""
 
-    logger.info(f"/convert ctype={ctype} vid_raw={repr(vid)} qp={dict(qp)}")
+    # ленивое форматирование: строка (и dict параметров) не собирается, если INFO выключен
+    logger.info("/convert ctype=%s vid_raw=%r qs=%s", ctype, vid, request.url.query)
     vid = extract_video_id(vid or "")
     if not vid:
-        return JSONResponse(status_code=200, content={"ok": False, "error": "video_id_missing_or_invalid"})
-
-    target = mp3_path_for(vid)
-    if not is_fresh(target):
-        # 1) yt-dlp: перебор клиентов
-        stream_url = try_extract_info_with_clients(vid)
-        if stream_url:
-            if not ffmpeg_transcode_to_mp3(stream_url, target):
-                return JSONResponse(status_code=200, content={"ok": False, "error": "ffmpeg_failed"})
-        else:
-            # 2) Piped → ffmpeg
-            audio_url = piped_best_audio_url(vid)
-            if audio_url:
-                if not ffmpeg_transcode_to_mp3(audio_url, target):
-                    return JSONResponse(status_code=200, content={"ok": False, "error": "ffmpeg_failed"})
-            else:
-                return JSONResponse(status_code=200, content={
-                    "ok": False,
-                    "error": "youtube_requires_cookies_or_piped_failed",
-                    "cookies_loaded": bool(COOKIES_PATH),
-                })
+        return ORJSONResponse(status_code=200, content={"ok": False, "error": "video_id_missing_or_invalid"})
+
+    target = fresh_media_path(vid)
+    if target:
+        lru_touch(target)  # каждое проигрывание идёт через /convert — здесь и отмечаем обращение
+    else:
+        async with single_flight(vid), _CONVERT_SEM:
+            # пока ждали, параллельный запрос на тот же vid мог уже всё скачать
+            target = fresh_media_path(vid)
+            if not target:
+                target = media_path_for(vid)
+                # блокирующий yt-dlp — в пул потоков, чтобы не замораживать event loop
+                loop = asyncio.get_running_loop()
+                # 1) yt-dlp: перебор клиентов
+                extracted = await loop.run_in_executor(executor, extract_audio_cached, vid)
+                if extracted:
+                    stream_url, acodec, headers = extracted
+                    if m4a_copy_ok(acodec):
+                        target = media_path_for(vid, ".m4a")
+                        ok = await ffmpeg_copy_to_m4a(stream_url, target, headers)
+                    else:
+                        ok = await ffmpeg_transcode_to_mp3(stream_url, target, headers)
+                    if not ok:
+                        forget_stream(vid)
+                        return ORJSONResponse(status_code=200, content={"ok": False, "error": "ffmpeg_failed"})
+                else:
+                    # 2) Piped → ffmpeg
+                    piped = await piped_best_audio_url(vid)
+                    if piped:
+                        audio_url, codec, kbps = piped
+                        if not await ffmpeg_transcode_stream_to_mp3(audio_url, target, copy=mp3_copy_ok(codec, kbps)):
+                            forget_stream(vid)
+                            return ORJSONResponse(status_code=200, content={"ok": False, "error": "ffmpeg_failed"})
+                    else:
+                        return ORJSONResponse(status_code=200, content={
+                            "ok": False,
+                            "error": "youtube_requires_cookies_or_piped_failed",
+                            "cookies_loaded": bool(COOKIES_PATH),
+                        })
 
     db_add_play(vid, title or "", nick or "", ip or "", serial or "")
     rel = os.path.basename(target)
+    # ключ "mp3" оставлен для совместимости с клиентами, даже если файл .m4a
     return {"ok": True, "video_id": vid, "mp3": f"/media/{rel}"}
 
 # ---------- Diagnostics ----------
@@ -339,13 +964,11 @@ def diag(video_id: str):
     vid = extract_video_id(video_id)
     if not vid:
         return {"ok": False, "where": "input", "msg": "bad video_id"}
-    url = f"https://www.youtube.com/watch?v={vid}"
     try:
-        with YoutubeDL(YDL_INFO_DEFAULT) as ydl:
+        with ydl_for_client("web") as ydl:  # те же опции, что YDL_INFO_DEFAULT
             params = dict(ydl.params)
-            info = ydl.extract_info(url, download=False)
-        fmts = info.get("formats") or []
-        audio_only = [f for f in fmts if (f.get("vcodec") in (None,"none")) and (f.get("acodec") not in (None,"none")) and f.get("url")]
+        fmts = ydl_formats("web", vid)
+        audio_only = audio_only_formats(fmts)
         sample = []
         for f in audio_only[:5]:
             sample.append({
@@ -379,23 +1002,19 @@ def diag_clients(video_id: str):
     vid = extract_video_id(video_id)
     if not vid:
         return {"ok": False, "msg": "bad video_id"}
-    url = f"https://www.youtube.com/watch?v={vid}"
     has_cookies = bool(COOKIES_PATH)
     order = PLAYER_CLIENTS_WITH_COOKIES if has_cookies else PLAYER_CLIENTS_NO_COOKIES
     out = []
     for client in order:
-        opts = ydl_base_opts(client)
         item = {"client": client}
         try:
-            with YoutubeDL(opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-            fmts = (info or {}).get("formats") or []
-            audio_only = [f for f in fmts if (f.get("vcodec") in (None,"none")) and (f.get("acodec") not in (None,"none")) and f.get("url")]
+            fmts = ydl_formats(client, vid)
+            audio_only = audio_only_formats(fmts)
             item.update({
                 "ok": True,
                 "formats_total": len(fmts),
                 "audio_only": len(audio_only),
-                "picked": bool(pick_best_audio_from_formats(fmts)),
+                "picked": bool(audio_only),  # pick_best_audio_from_formats выбирает из этого же списка
             })
         except Exception as e:
             item.update({"ok": False, "error": str(e)})
@@ -403,49 +1022,86 @@ def diag_clients(video_id: str):
     return {"ok": True, "cookies_loaded": has_cookies, "ua": UA, "results": out}
 
 @app.get("/diag_piped")
-def diag_piped(video_id: str):
+async def diag_piped(video_id: str):
     vid = extract_video_id(video_id)
     if not vid:
         return {"ok": False, "msg": "bad video_id"}
-    results = []
-    for base in PIPED_INSTANCES:
+    async def probe(base: str) -> dict:
         try:
-            url = f"{base.rstrip('/')}/api/v1/streams/{vid}"
-            req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
-            with urllib.request.urlopen(req, timeout=PIPED_TIMEOUT) as resp:
-                body = json.loads(resp.read().decode("utf-8","ignore"))
-                results.append({"instance": base, "status": resp.status, "have_audio": bool(body.get("audioStreams"))})
+            resp = await _piped_client.get(f"{base.rstrip('/')}/api/v1/streams/{vid}")
+            body = orjson.loads(resp.content)
+            return {"instance": base, "status": resp.status_code, "have_audio": bool(body.get("audioStreams"))}
         except Exception as e:
-            results.append({"instance": base, "status": "error", "error": str(e)})
+            return {"instance": base, "status": "error", "error": str(e)}
+    # все инстансы разом: время ответа — самый медленный инстанс, а не сумма таймаутов
+    results = await asyncio.gather(*(probe(base) for base in PIPED_INSTANCES))
     return {"ok": True, "results": results}
 
 # ---------- Static / status ----------
-@app.get("/media/{filename}")
-def media(filename: str):
-    if not re.fullmatch(r"[0-9A-Za-z_-]+\.mp3", filename): raise HTTPException(status_code=404, detail="not found")
+def valid_media_name(name: str) -> bool:
+    # эквивалент [0-9A-Za-z_-]+\.(mp3|m4a) без regex
+    stem, ext = os.path.splitext(name)
+    return ext in MEDIA_TYPES and bool(stem) and _VID_CHARS.issuperset(stem)
+
+# За nginx: X_ACCEL_PREFIX=/_protected_media/ + `location /_protected_media/ { internal; alias /data/; }` —
+# байты отдаёт nginx через sendfile(2), Python их не трогает. Пусто (по умолчанию) — отдаём сами.
+X_ACCEL_PREFIX = os.environ.get("X_ACCEL_PREFIX", "")
+
+# HEAD — плееры пробуют размер/тип до загрузки; FileResponse сам отдаёт только заголовки
+@app.api_route("/media/{filename}", methods=["GET", "HEAD"])
+def media(filename: str, request: Request):
+    if not valid_media_name(filename): raise HTTPException(status_code=404, detail="not found")
+    media_type = MEDIA_TYPES[os.path.splitext(filename)[1]]
+    if X_ACCEL_PREFIX:
+        return Response(status_code=200, media_type=media_type,
+                        headers={"X-Accel-Redirect": f"{X_ACCEL_PREFIX.rstrip('/')}/{filename}"})
     path = os.path.join(MEDIA_ROOT, filename)
-    if not os.path.exists(path): raise HTTPException(status_code=404, detail="not found")
-    return FileResponse(path, media_type="audio/mpeg")
+    # один stat вместо exists + повторного stat внутри FileResponse; Range (перемотка) Starlette отдаёт как 206
+    try: st = os.stat(path)
+    except OSError: raise HTTPException(status_code=404, detail="not found")
+    # ETag из inode/size (без md5): новый файл всегда приходит через os.replace — новый inode,
+    # а utime от lru_touch его не меняет, и 304 у клиентов не слетают раз в TOUCH_INTERVAL
+    etag = f'"{st.st_ino:x}-{st.st_size:x}"'
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={CACHE_TTL_SECONDS}"}
+    if etag in (request.headers.get("if-none-match") or ""):
+        return Response(status_code=304, headers=headers)
+    headers.update({"X-Accel-Buffering": "no", "Accept-Ranges": "bytes"})
+    return FileResponse(path, media_type=media_type, stat_result=st, headers=headers)
 
 @app.get("/status")
 def status():
+    # один scandir и один time.time(): DirEntry.stat() без лишних syscalls, возраст от общего now
+    now = time.time()
     files = []
-    for name in os.listdir(MEDIA_ROOT):
-        if name.endswith(".mp3"):
-            p = os.path.join(MEDIA_ROOT, name)
-            files.append({"file": name, "size": os.path.getsize(p), "age_seconds": int(time.time()-os.path.getmtime(p))})
-    return {"now": int(time.time()), "cache_ttl_sec": CACHE_TTL_SECONDS, "files": sorted(files, key=lambda x: x["age_seconds"]), "recent_plays": db_recent(50)}
+    with os.scandir(MEDIA_ROOT) as it:
+        for e in it:
+            if e.name.endswith(MEDIA_EXTS):
+                try: st = e.stat()
+                except OSError: continue
+                files.append({"file": e.name, "size": st.st_size, "age_seconds": int(now - st.st_mtime)})
+    files.sort(key=lambda x: x["age_seconds"])
+    return {"now": int(now), "cache_ttl_sec": CACHE_TTL_SECONDS, "files": files, "recent_plays": db_recent(50)}
+
+# всё в сводке известно при старте — сериализуем один раз и отдаём готовые байты
+_ROOT_JSON = orjson.dumps({
+    "service": "YouTube MP3 Bridge for MTA",
+    "endpoints": ["/search?q=", "/convert", "/media/<file>", "/status", "/ping", "/diag?video_id=", "/diag_clients?video_id=", "/diag_piped?video_id="],
+    "cache_ttl_sec": CACHE_TTL_SECONDS,
+    "cookies_loaded": bool(COOKIES_PATH),
+    "ua": UA,
+    "piped_instances": PIPED_INSTANCES,
+})
 
 @app.get("/")
-def root():
-    return {
-        "service": "YouTube MP3 Bridge for MTA",
-        "endpoints": ["/search?q=", "/convert", "/media/<file>", "/status", "/ping", "/diag?video_id=", "/diag_clients?video_id=", "/diag_piped?video_id="],
-        "cache_ttl_sec": CACHE_TTL_SECONDS,
-        "cookies_loaded": bool(COOKIES_PATH),
-        "ua": UA,
-        "piped_instances": PIPED_INSTANCES,
-    }
+async def root():
+    return Response(content=_ROOT_JSON, media_type="application/json")
 
 if __name__ == "__main__":
-    uvicorn.run("app:app", host="0.0.0.0", port=PORT, reload=False)
+    # uvloop + httptools (идут с uvicorn[standard]). Число процессов — WEB_CONCURRENCY, как в CMD образа
+    # (uvicorn из командной строки читает ту же переменную). Каждый процесс открывает свои соединения SQLite,
+    # WAL + BEGIN IMMEDIATE + busy_timeout дают писать в общую БД из нескольких процессов.
+    # Кэши в памяти (_FS_CACHE, LRU, ссылки extract/Piped, пулы YoutubeDL) у каждого процесса свои,
+    # как и single_flight с _CONVERT_SEM: одновременные /convert одного vid в разных процессах перекодируют
+    # его дважды (каждый в свой .<pid>.part, os.replace атомарен), а ffmpeg'ов до WEB_CONCURRENCY × CONVERT_CONCURRENCY
+    uvicorn.run("app:app", host="0.0.0.0", port=PORT, reload=False, loop="uvloop", http="httptools",
+                workers=int(os.environ.get("WEB_CONCURRENCY", "2")))